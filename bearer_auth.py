@@ -1,5 +1,6 @@
 import base64
 import binascii
+import hmac
 
 
 class BearerAuth(object):
@@ -10,6 +11,8 @@ class BearerAuth(object):
     def __init__(self, key: str, encoding='utf-8'):
         self._key = key
         self._encoding = encoding
+        self._encoded_key = key.encode(encoding)
+        self._token = base64.b64encode(self._encoded_key)
 
     @property
     def key(self) -> str:
@@ -17,27 +20,40 @@ class BearerAuth(object):
 
     @classmethod
     def decode(cls, auth_header: str, encoding='utf-8') -> 'BearerAuth':
-        split = auth_header.strip().split(' ')
-        if len(split) == 2:
-            if split[0].strip().lower() != 'bearer':
-                raise ValueError('Unknown authorization method {}'.format(split[0]))
-            encoded_key = split[1]
-        else:
+        method, separator, encoded_key = auth_header.strip().partition(' ')
+        if not separator or ' ' in encoded_key:
             raise ValueError('Could not parse authorization header')
+        if method.lower() != 'bearer':
+            raise ValueError('Unknown authorization method {}'.format(method))
 
         try:
-            return cls(base64.b64decode(encoded_key.encode('ascii')).decode('utf-8'), encoding=encoding)
+            return cls(base64.b64decode(encoded_key).decode(encoding), encoding=encoding)
         except binascii.Error:
             raise ValueError('Invalid base64 encoding')
 
     def encode(self) -> str:
-        return 'Bearer {}'.format(base64.b64encode(self._key.encode(self._encoding))).decode(self._encoding)
+        return 'Bearer {}'.format(self._token.decode('ascii'))
+
+    def matches(self, auth_header: str) -> bool:
+        """
+        Check an authorization header against this key without decoding the header
+        """
+        method, _, token = auth_header.strip().partition(' ')
+        if method.lower() != 'bearer':
+            return False
+
+        # Constant time, so the comparison does not leak how much of the token matched
+        return hmac.compare_digest(token.encode('ascii', errors='replace'), self._token)
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return False
 
-        return self._key.encode(self._encoding) == other._key.encode(self._encoding)
+        # Constant time, so the comparison does not leak how much of a given key matched
+        return hmac.compare_digest(self._encoded_key, other._encoded_key)
+
+    def __hash__(self) -> int:
+        return hash(self._encoded_key)
 
     def __repr__(self) -> str:
         return "{}('{}', encoding='{}')".format(self.__class__.__name__, self._key, self._encoding)
@@ -1,23 +1,25 @@
-from datetime import datetime, timedelta, timezone
-import json
+import aiohttp
+import asyncio
+from datetime import datetime, timezone
+import heapq
+import itertools
 import logging
 from marshmallow import Schema, fields
-from multiprocessing import Manager, Pool
+import orjson
 import os
-import re
-import requests
-import select
-import shlex
 from shutil import move
-import signal
-import subprocess
+import time
 from typing import Dict, List, Optional
-from urllib.parse import urlparse, urlunparse, ParseResult
+from urllib.parse import quote
 from uuid import uuid4
 
 from hikvision import Camera
 
-PROGRESS_RE = re.compile(r'\s*(frame|fps|q|size|time|bitrate|speed)\s*=\s*(\S+)\s*')
+# Persist progress to the job file at most once per this many percent and seconds
+PROGRESS_PERSIST_STEP = 1.0
+PROGRESS_PERSIST_INTERVAL = 1.0
+PIPE_READ_SIZE = 65536
+CALLBACK_TIMEOUT = 30
 
 
 class JobSchema(Schema):
@@ -34,21 +36,9 @@ class JobSchema(Schema):
     error = fields.String()
 
 
-class JobException(Exception):
-    def __init__(self, job_id: str, parent_exception: Exception):
-        self._job_id = job_id
-        self._parent_exception = parent_exception
-
-    @property
-    def job_id(self) -> str:
-        return self._job_id
-
-    @property
-    def parent_exception(self) -> Exception:
-        return self._parent_exception
-
-    def __str__(self):
-        return 'Error while processing job {}: {}'.format(self.job_id, self.parent_exception)
+_JOB_SCHEMA = JobSchema()
+# Only these keys are written to job.json, the rest of the job dict is internal and would fail the schema on load
+_JOB_FIELDS = tuple(_JOB_SCHEMA.fields)
 
 
 class FFmpeg(object):
@@ -67,34 +57,81 @@ class FFmpeg(object):
             username: Optional[str] = None,
             password: Optional[str] = None,
             workers: int = 5,
-            max_downloads_per_child: int = 100
+            max_downloads_per_child: Optional[int] = None
     ):
+        """
+        The downloads are supervised on the event loop, at most `workers` ffmpeg processes run at the same time.
+        Queued downloads are started shortest first. `max_downloads_per_child` is a leftover from the process pool
+        and is ignored.
+        """
         self._spool_path = spool_path
         self._storage_path = storage_path
-        self._username = username
-        self._password = password
+        # Quoted once, so characters like / and # in the credentials can't break the RTSP URI
+        self._quoted_username = quote(username, safe='') if username else None
+        self._quoted_password = quote(password, safe='') if password else None
+
+        self._workers = workers
+        self._running = 0
+        # Heap of (duration in seconds, sequence, job id), the sequence keeps equally long jobs first come first served
+        self._queue = []
+        self._sequence = itertools.count()
 
-        self._manager = Manager()
-        self._pool = Pool(processes=workers, maxtasksperchild=max_downloads_per_child, initializer=self._initialize)
         self._jobs = {}
+        self._tasks = {}
+        # Active job id by (camera id, start time, end time), a repeated download joins the job already running
+        self._active = {}
+        # Serialized jobs by job id, dropped whenever the job changes
+        self._bodies = {}
+
+        # Shared by all the callbacks, so connections to the same callback host are reused
+        self._session = None
 
-    def __del__(self):
-        self._pool.terminate()
-        self._pool.join()
+    async def close(self):
+        self._queue.clear()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._session is not None:
+            await self._session.close()
 
     def get_job_by_id(self, job_id: str) -> Optional[Dict]:
-        if job_id not in self._jobs:
+        job = self._jobs.get(job_id)
+        if job is None:
             try:
                 job_file = os.path.join(self._spool_path, job_id, 'job.json')
-                with open(job_file, 'r') as fd:
-                    return JobSchema().load(json.load(fd))
+                with open(job_file, 'rb') as fd:
+                    return _JOB_SCHEMA.load(orjson.loads(fd.read()))
+            except FileNotFoundError:
+                return None
+
+        return job.copy()
+
+    def get_job_body_by_id(self, job_id: str) -> Optional[bytes]:
+        """
+        The job as JSON, served from the cached serialization while the job hasn't changed
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            # Finished jobs don't change any more, their job file holds the same JSON
+            try:
+                with open(os.path.join(self._spool_path, job_id, 'job.json'), 'rb') as fd:
+                    return fd.read()
             except FileNotFoundError:
                 return None
 
-        return dict(self._jobs[job_id])
+        return self._job_body(job)
+
+    def get_file_by_id(self, job_id: str) -> Optional[str]:
+        job = self.get_job_by_id(job_id)
+        if job is None or job['status'] != FFmpeg.DONE:
+            return None
+
+        return os.path.join(self._storage_path, job_id, job['filename'])
 
-    def get_all_active_jobs(self) -> List[Dict]:
-        return [dict(job) for job in self._jobs.values()]
+    def get_all_active_job_bodies(self) -> List[bytes]:
+        return [self._job_body(job) for job in self._jobs.values()]
 
     def download(
             self,
@@ -105,6 +142,14 @@ class FFmpeg(object):
             filename: str,
             callback_uri: Optional[str] = None
     ) -> Dict:
+        key = (camera.id, start_time, end_time)
+        if key in self._active:
+            job = self._jobs[self._active[key]]
+            if callback_uri is not None and callback_uri not in job['callback_uris']:
+                job['callback_uris'].append(callback_uri)
+            FFmpeg.info('Joined by a repeated download', job=job)
+            return job.copy()
+
         job_id = str(uuid4())
 
         spool_dir = os.path.join(self._spool_path, job_id)
@@ -112,7 +157,7 @@ class FFmpeg(object):
 
         FFmpeg.info('Pending', job=job_id)
 
-        self._jobs[job_id] = self._manager.dict({})
+        self._jobs[job_id] = {}
         initialize_job = {
             'job_id': job_id,
             'camera_id': camera.id,
@@ -123,135 +168,198 @@ class FFmpeg(object):
             'rtsp_uri': rtsp_uri,
             'storage_path': os.path.join(self._storage_path, job_id),
             'status': FFmpeg.PENDING,
-            'progress': 0,
+            'progress': 0.0,
             'requested_at': datetime.now(tz=timezone.utc),
-            'callback_uri': callback_uri,
+            'callback_uris': [callback_uri] if callback_uri is not None else [],
         }
 
-        FFmpeg._job_update(self._jobs[job_id], **initialize_job)
+        self._job_update(self._jobs[job_id], **initialize_job)
+        self._active[key] = job_id
 
-        self._pool.apply_async(
-            FFmpeg._download_process,
-            (self._jobs[job_id], self._username, self._password),
-            callback=self._done,
-            error_callback=self._error
-        )
+        heapq.heappush(self._queue, ((end_time - start_time).total_seconds(), next(self._sequence), job_id))
+        self._dispatch()
 
         return initialize_job
 
-    def _done(self, job_id: str):
+    def _dispatch(self):
+        while self._running < self._workers and self._queue:
+            _, _, job_id = heapq.heappop(self._queue)
+            self._running += 1
+            self._tasks[job_id] = asyncio.ensure_future(self._run(self._jobs[job_id]))
+
+    async def _run(self, job: Dict):
+        try:
+            await self._download(job)
+        except Exception as ex:
+            self._job_update(job, status=FFmpeg.ERROR, error=str(ex), done_at=datetime.now(tz=timezone.utc))
+            FFmpeg.error('Exception: {}'.format(str(ex)), job=job, exc_info=ex)
+        finally:
+            self._running -= 1
+            self._dispatch()
+
+        await self._done(job['job_id'])
+
+    async def _done(self, job_id: str):
         job = self._jobs[job_id]
+        # Stop merging new downloads into this job before the callbacks are made
+        del self._active[(job['camera_id'], job['start_time'], job['end_time'])]
 
         FFmpeg.info('Done {}'.format(str(job)), job=job_id)
 
-        callback_uri = job.get('callback_uri', None)
-        if callback_uri is not None:
+        errors = []
+        for callback_uri in job['callback_uris']:
             try:
                 FFmpeg.debug('Calling callback URI {}'.format(callback_uri), job=job_id)
-                response = requests.post(callback_uri, json=JobSchema().dump(job), timeout=30)
-                FFmpeg.debug('Callback URI response: {} {}'.format(response.status_code, response.text), job=job_id)
-                response.raise_for_status()
+                if self._session is None:
+                    self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=CALLBACK_TIMEOUT))
+
+                async with self._session.post(
+                        callback_uri,
+                        data=self._job_body(job),
+                        headers={'Content-Type': 'application/json'}
+                ) as response:
+                    FFmpeg.debug(
+                        'Callback URI response: {} {}'.format(response.status, await response.text()),
+                        job=job_id
+                    )
+                    response.raise_for_status()
             except Exception as ex:
                 message = 'Failed calling callback URI {}: {}'.format(callback_uri, str(ex))
-                self._job_update(job, error=message)
+                errors.append(message)
                 FFmpeg.error(message, job=job, exc_info=ex)
 
+        if errors:
+            self._job_update(job, error='\n'.join(errors))
+
         del self._jobs[job_id]
+        del self._tasks[job_id]
+        self._bodies.pop(job_id, None)
 
-    def _error(self, ex):
-        if isinstance(ex, JobException):
-            FFmpeg.error('Exception: {}'.format(str(ex)), job=ex.job_id, exc_info=ex)
-            FFmpeg.error('Parent exception', job=ex.job_id, exc_info=ex.parent_exception)
+    def _job_update(self, job: Dict, **kwargs):
+        self._job_update_memory(job, **kwargs)
+        self._job_persist(job)
 
-            self._done(ex.job_id)
-        else:
-            FFmpeg.error('Error {}'.format(str(ex)), exc_info=ex)
-
-    @staticmethod
-    def _job_update(job: Dict, **kwargs):
+    def _job_update_memory(self, job: Dict, **kwargs):
         job.update(kwargs)
+        self._bodies.pop(job['job_id'], None)
         FFmpeg.debug("Update: {}".format(str(kwargs)), job=job)
-        with open(os.path.join(job['spool_path'], 'job.json'), 'w') as fd:
-            json.dump(JobSchema().dump(job), fd)
-
-    @staticmethod
-    def _download_process(
-            job: Dict,
-            username: Optional[str] = None,
-            password: Optional[str] = None
-    ) -> str:
-        try:
-            if username and password:
-                parsed_uri = urlparse(job['rtsp_uri'])
-                uri = urlunparse(
-                    ParseResult(
-                        parsed_uri.scheme,
-                        '{}:{}@{}'.format(username, password, parsed_uri.netloc),
-                        parsed_uri.path,
-                        '',
-                        parsed_uri.query,
-                        ''
-                    )
-                )
-            else:
-                uri = job['rtsp_uri']
 
+    def _job_body(self, job: Dict) -> bytes:
+        body = self._bodies.get(job['job_id'])
+        if body is None:
+            body = orjson.dumps({key: job[key] for key in _JOB_FIELDS if key in job})
+            self._bodies[job['job_id']] = body
+        return body
+
+    def _job_persist(self, job: Dict):
+        job_file = os.path.join(job['spool_path'], 'job.json')
+        with open(job_file + '.tmp', 'wb') as fd:
+            fd.write(self._job_body(job))
+        # Replace atomically so readers never see a partially written file
+        os.replace(job_file + '.tmp', job_file)
+
+    async def _download(self, job: Dict):
+        if self._quoted_username and self._quoted_password:
+            scheme, _, rest = job['rtsp_uri'].partition('://')
+            uri = '{}://{}:{}@{}'.format(scheme, self._quoted_username, self._quoted_password, rest)
+            FFmpeg.debug('Getting video data from {}://{}:***@{}'.format(scheme, self._quoted_username, rest), job=job)
+        else:
+            uri = job['rtsp_uri']
             FFmpeg.debug('Getting video data from {}'.format(uri), job=job)
 
-            spool_file = os.path.join(job['spool_path'], job['filename'])
+        spool_file = os.path.join(job['spool_path'], job['filename'])
+        duration_seconds = (job['end_time'] - job['start_time']).total_seconds()
+
+        ffmpeg_cmd = [
+            'ffmpeg', '-hide_banner', '-y',
+            '-rtsp_transport', 'tcp', '-rtsp_flags', 'prefer_tcp',
+            '-i', uri,
+            '-vcodec', 'copy', '-an',
+            # Let ffmpeg stop by itself once the requested range has been recorded
+            '-t', str(duration_seconds),
+            spool_file
+        ]
+
+        time_seconds = 0.0
+        persisted_progress = 0.0
+        persisted_at = time.monotonic()
+
+        FFmpeg.info('Starting', job=job)
+        ffmpeg = await asyncio.create_subprocess_exec(
+            *ffmpeg_cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
 
-            ffmpeg_cmd = shlex.split(
-                'ffmpeg -hide_banner -y -rtsp_transport tcp -rtsp_flags prefer_tcp -i "{}" -vcodec copy -an "{}"'
-                .format(uri, spool_file)
+        try:
+            self._job_update(job, status=FFmpeg.RUNNING, started_at=datetime.now(tz=timezone.utc))
+
+            output = bytearray()
+            while True:
+                buf = await ffmpeg.stderr.read(PIPE_READ_SIZE)
+                if not buf:
+                    break
+
+                output += buf
+                # Parse the accumulated output, a progress record may be split over two reads
+                progress_seconds = FFmpeg._parse_progress_time(output)
+                if progress_seconds is not None and progress_seconds != time_seconds:
+                    time_seconds = progress_seconds
+                    progress = time_seconds / max(time_seconds, duration_seconds) * 100
+                    self._job_update_memory(job, progress=progress)
+                    now = time.monotonic()
+                    if progress - persisted_progress >= PROGRESS_PERSIST_STEP \
+                            and now - persisted_at >= PROGRESS_PERSIST_INTERVAL:
+                        self._job_persist(job)
+                        persisted_progress = progress
+                        persisted_at = now
+
+            await ffmpeg.wait()
+        finally:
+            # Don't leave ffmpeg running when the job is cancelled
+            if ffmpeg.returncode is None:
+                ffmpeg.kill()
+                await ffmpeg.wait()
+
+        if ffmpeg.returncode != 0:
+            raise Exception('FFmpeg failed: {}'.format(output.decode('utf-8', errors='replace')))
+
+        if job['spool_path'] != job['storage_path']:
+            self._job_update(job, status=FFmpeg.MOVING, progress=100.0)
+            os.makedirs(job['storage_path'], exist_ok=True)
+            # Moving to another file system copies the whole file, keep that off the event loop
+            await asyncio.get_event_loop().run_in_executor(
+                None,
+                move,
+                spool_file,
+                os.path.join(job['storage_path'], job['filename'])
             )
 
-            time = timedelta()
-            duration = job['end_time'] - job['start_time']
-
-            (read_pipe, write_pipe) = os.pipe()
-            FFmpeg.info('Starting', job=job)
-            ffmpeg = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=write_pipe)
-
-            FFmpeg._job_update(job, status=FFmpeg.RUNNING, started_at=datetime.now(tz=timezone.utc))
-
-            output = ''
-            stopping = False
-            while ffmpeg.poll() is None:
-                fd_count = len(select.select([read_pipe], [], [], 1)[0])
-                if fd_count == 1:
-                    buf = os.read(read_pipe, 1024).decode('utf-8')
-                    output += buf
-                    progress = dict(PROGRESS_RE.findall(buf))
-                    if 'frame' in progress and 'size' in progress and 'time' in progress:
-                        hours, minutes, seconds = progress['time'].split(':')
-                        time = timedelta(hours=int(hours), minutes=int(minutes), seconds=float(seconds))
-                        FFmpeg._job_update(
-                            job,
-                            progress=time.total_seconds() / max(time.total_seconds(), duration.total_seconds()) * 100
-                        )
-
-                if not stopping and time.total_seconds() > duration.total_seconds() and ffmpeg.poll() is None:
-                    FFmpeg.debug('Stopping ffmpeg', job=job)
-                    ffmpeg.terminate()
-                    stopping = True
-
-            ffmpeg.wait()
-
-            if not stopping and ffmpeg.returncode != 0:
-                raise Exception('FFmpeg failed: {}'.format(output))
-
-            if job['spool_path'] != job['storage_path']:
-                FFmpeg._job_update(job, status=FFmpeg.MOVING, progress=100)
-                os.makedirs(job['storage_path'], exist_ok=True)
-                move(spool_file, os.path.join(job['storage_path'], job['filename']))
-
-            FFmpeg._job_update(job, status=FFmpeg.DONE, progress=100, done_at=datetime.now(tz=timezone.utc))
-
-            return job['job_id']
-        except Exception as ex:
-            FFmpeg._job_update(job, status=FFmpeg.ERROR, error=str(ex), done_at=datetime.now(tz=timezone.utc))
-            raise JobException(job['job_id'], ex)
+        self._job_update(job, status=FFmpeg.DONE, progress=100.0, done_at=datetime.now(tz=timezone.utc))
 
+    @staticmethod
+    def _parse_progress_time(buf: bytes) -> Optional[float]:
+        # Progress records look like "frame=... fps=... size=... time=HH:MM:SS.ss bitrate=... speed=...\r", only the
+        # time value of the last complete record is needed
+        record_end = buf.rfind(b'\r')
+        if record_end < 0:
+            return None
+
+        record_start = buf.rfind(b'\r', 0, record_end) + 1
+        start = buf.rfind(b'time=', record_start, record_end)
+        if start < 0:
+            return None
+
+        end = buf.find(b' ', start, record_end)
+        if end < 0:
+            return None
+
+        try:
+            hours, minutes, seconds = buf[start + 5:end].split(b':')
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except ValueError:
+            # E.g. "time=N/A" before the first packet is written
+            return None
 
     @staticmethod
     def log(level: int, message: str, job: Optional = None, **kwargs):
@@ -273,8 +381,3 @@ class FFmpeg(object):
     @staticmethod
     def error(message: str, job: Optional = None, **kwargs):
         FFmpeg.log(logging.ERROR, message, job=job, **kwargs)
-
-    @staticmethod
-    def _initialize():
-        # Prevent a keyboard interrupt from terminating a Pool process, this is handled by the destructor of this class
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
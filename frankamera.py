@@ -1,19 +1,33 @@
 from aiohttp import web
 from aiohttp_apispec import docs, request_schema, response_schema, setup_aiohttp_apispec
-import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
 import logging
 import logging.config
-from marshmallow import Schema, fields, exceptions
+from logging.handlers import QueueHandler, QueueListener
+from marshmallow import EXCLUDE, Schema, fields, exceptions, validate
+import orjson
 import os
+import queue
 import sys
 import traceback
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+import uuid
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from bearer_auth import BearerAuth
 from ffmpeg import FFmpeg, JobSchema
 from hikvision import (
     Hikvision,
+    Camera,
     CameraSchema,
+    Result,
     ResultSchema,
     CameraNotFoundException,
     InvalidRangeException,
@@ -22,6 +36,12 @@ from hikvision import (
 
 DEFAULT_PORT = 19340
 DEFAULT_LOG_LEVEL = 'info'
+FILE_CHUNK_SIZE = 1 << 20
+# Threads for the blocking DVR client, so slow DVR calls don't hold up the rest of the default executor
+DVR_WORKERS = 4
+SERVER_NAME = 'Frankamera'
+# Seconds clients may reuse a /cameras response before revalidating it with its ETag
+CAMERAS_MAX_AGE = 10
 
 
 class ErrorResponseSchema(Schema):
@@ -34,46 +54,138 @@ class SearchRequestSchema(Schema):
     camera_id = fields.Integer(required=True)
     start_time = fields.DateTime(required=True)
     end_time = fields.DateTime(required=True)
+    no_cache = fields.Boolean(missing=False)
 
 
 class DownloadRequestSchema(SearchRequestSchema):
     callback_uri = fields.Url(required=True)
 
 
+class LogConfigSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    path = fields.String()
+    level = fields.String(missing=DEFAULT_LOG_LEVEL)
+
+
+class HikvisionConfigSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    base_url = fields.String(required=True)
+    username = fields.String(required=True)
+    password = fields.String(required=True)
+
+
+class ServerConfigSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    port = fields.Integer(missing=DEFAULT_PORT)
+    api_key = fields.String(missing=None, allow_none=True)
+    spool = fields.String(missing='.')
+    storage = fields.String(missing='.')
+    log = fields.Nested(LogConfigSchema, missing=lambda: LogConfigSchema().load({}))
+
+
+class FFmpegPoolConfigSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    workers = fields.Integer(validate=validate.Range(min=1))
+    max_downloads_per_child = fields.Integer(allow_none=True)
+
+
+class ConfigSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    hikvision = fields.Nested(HikvisionConfigSchema, required=True)
+    server = fields.Nested(ServerConfigSchema, missing=lambda: ServerConfigSchema().load({}))
+    ffmpeg_pool = fields.Nested(FFmpegPoolConfigSchema, missing=dict)
+    debug = fields.Boolean(missing=False)
+
+
+# Schemas are stateless once constructed, so share a single instance of each between requests
+_CONFIG_SCHEMA = ConfigSchema()
+_SEARCH_REQUEST_SCHEMA = SearchRequestSchema()
+_DOWNLOAD_REQUEST_SCHEMA = DownloadRequestSchema()
+
+# HTTP status codes for the exceptions the handlers let propagate to the middleware
+EXCEPTION_STATUS = {
+    CameraNotFoundException: 404,
+    InvalidRangeException: 409,
+    RangeNotFoundException: 416,
+}
+
+
+def json_response(data, status: int = 200) -> web.Response:
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
+
+
+def compact_timestamp(dt: datetime) -> str:
+    """
+    Same as dt.strftime('%Y%m%dT%H%M%S%z'), without strftime parsing the format on every call
+    """
+    offset = dt.utcoffset()
+    if offset is None:
+        zone = ''
+    else:
+        minutes = int(offset.total_seconds()) // 60
+        zone = '{}{:02d}{:02d}'.format('-' if minutes < 0 else '+', abs(minutes) // 60, abs(minutes) % 60)
+
+    return '{:04d}{:02d}{:02d}T{:02d}{:02d}{:02d}{}'.format(
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, zone
+    )
+
+
 class Frankamera(object):
     def __init__(self, config='frankamera.json'):
-        with open(config) as fd:
-            self._config = json.load(fd)
+        with open(config, 'rb') as fd:
+            # Fills in the defaults, so the settings below can be looked up directly
+            self._config = _CONFIG_SCHEMA.load(orjson.loads(fd.read()))
 
-        self.dvr = Hikvision(
-            self._config.get('hikvision').get('base_url'),
-            self._config.get('hikvision').get('username'),
-            self._config.get('hikvision').get('password')
-        )
+        hikvision_config = self._config['hikvision']
+        username = hikvision_config['username']
+        password = hikvision_config['password']
+
+        self.dvr = Hikvision(hikvision_config['base_url'], username, password)
 
-        server_config = self._config.get('server', {})
+        server_config = self._config['server']
 
         self._setup_logging()
 
         self.ffmpeg = FFmpeg(
-            os.path.realpath(server_config.get('spool', '.')),
-            os.path.realpath(server_config.get('storage', '.')),
-            username=self._config.get('hikvision').get('username'),
-            password=self._config.get('hikvision').get('password'),
-            **self._config.get('ffmpeg_pool', {})
+            os.path.realpath(server_config['spool']),
+            os.path.realpath(server_config['storage']),
+            username=username,
+            password=password,
+            **self._config['ffmpeg_pool']
         )
 
-        self._port = server_config.get('port', DEFAULT_PORT)
+        self._port = server_config['port']
 
-        api_key = server_config.get('api_key', None)
+        api_key = server_config['api_key']
         self._api_key = BearerAuth(api_key) if api_key is not None else None
 
-        self._protected_routes = {}
+        self._protected_routes = set()
+
+        # Serialized /cameras response, rebuilt whenever the DVR refreshes its camera list
+        self._cameras_body = None
+        self._cameras_etag = None
+        self._cameras_refreshed_at = None
+
+        self._dvr_executor = None
+
+        # DVR searches in progress by their arguments, identical requests wait for the same search
+        self._searches = {}
 
     def _setup_logging(self):
-        log_config = self._config.get('server', {}).get('log', {})
+        log_config = self._config['server']['log']
 
         self._logger = logging.getLogger('frankamera')
+        self._log_listeners = []
 
         if 'path' in log_config:
             os.makedirs(log_config['path'], exist_ok=True)
@@ -81,7 +193,10 @@ class Frankamera(object):
 
             access_logger = logging.getLogger('aiohttp.access')
             access_logger.setLevel(logging.INFO)
-            access_logger.addHandler(logging.FileHandler(os.path.join(log_config['path'], 'access.log')))
+            self._add_queued_handler(
+                access_logger,
+                logging.FileHandler(os.path.join(log_config['path'], 'access.log'))
+            )
         else:
             handler = logging.StreamHandler(sys.stderr)
 
@@ -89,8 +204,16 @@ class Frankamera(object):
             logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S%z')
         )
 
-        self._logger.setLevel(log_config.get('level', DEFAULT_LOG_LEVEL).upper())
-        self._logger.addHandler(handler)
+        self._logger.setLevel(log_config['level'].upper())
+        self._add_queued_handler(self._logger, handler)
+
+    def _add_queued_handler(self, logger: logging.Logger, handler: logging.Handler):
+        # The handler writes from the listener's thread, so logging never blocks the event loop on I/O
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+        self._log_listeners.append(listener)
+        logger.addHandler(QueueHandler(log_queue))
 
     @docs(
         summary='Get the registered cameras',
@@ -100,7 +223,23 @@ class Frankamera(object):
     )
     @response_schema(CameraSchema(many=True))
     async def cameras(self, request: web.Request):
-        return web.json_response(CameraSchema(many=True).dump([camera for camera in self.dvr.cameras.values()]))
+        # Reading the cameras may refresh them from the DVR
+        cameras = await asyncio.get_event_loop().run_in_executor(self._dvr_executor, lambda: self.dvr.cameras)
+        if self._cameras_refreshed_at != self.dvr.last_camera_refresh:
+            self._cameras_body = orjson.dumps([camera.to_dict() for camera in cameras.values()])
+            self._cameras_etag = '"{}"'.format(hashlib.blake2b(self._cameras_body, digest_size=8).hexdigest())
+            self._cameras_refreshed_at = self.dvr.last_camera_refresh
+
+        headers = {'ETag': self._cameras_etag, 'Cache-Control': 'max-age={}'.format(CAMERAS_MAX_AGE)}
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and (
+                if_none_match.strip() == '*'
+                or self._cameras_etag in (tag.strip() for tag in if_none_match.split(','))
+        ):
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(body=self._cameras_body, headers=headers, content_type='application/json')
 
     @docs(
         summary='Search for stored video data',
@@ -115,20 +254,9 @@ class Frankamera(object):
     @request_schema(SearchRequestSchema())
     @response_schema(ResultSchema())
     async def search(self, request: web.Request):
-        try:
-            data = SearchRequestSchema().load(await request.json())
-            result = self.dvr.search(
-                self.dvr.get_camera_by_id(data['camera_id']),
-                data['start_time'],
-                data['end_time']
-            )
-            return web.json_response(ResultSchema().dump(result))
-        except CameraNotFoundException as ex:
-            raise web.HTTPNotFound(reason=str(ex))
-        except InvalidRangeException as ex:
-            raise web.HTTPConflict(reason=str(ex))
-        except RangeNotFoundException as ex:
-            raise web.HTTPRequestRangeNotSatisfiable(reason=str(ex))
+        data = _SEARCH_REQUEST_SCHEMA.load(orjson.loads(await request.read()))
+        _, result = await self._search(data['camera_id'], data['start_time'], data['end_time'], data['no_cache'])
+        return json_response(result.to_dict())
 
     @docs(
         summary='Download video data',
@@ -144,34 +272,31 @@ class Frankamera(object):
     @request_schema(DownloadRequestSchema())
     @response_schema(JobSchema())
     async def download(self, request: web.Request):
-        try:
-            data = DownloadRequestSchema().load(await request.json())
+        data = _DOWNLOAD_REQUEST_SCHEMA.load(orjson.loads(await request.read()))
 
-            camera = self.dvr.get_camera_by_id(data['camera_id'])
-            result = self.dvr.search(camera, data['start_time'], data['end_time'])
+        camera, result = await self._search(
+            data['camera_id'],
+            data['start_time'],
+            data['end_time'],
+            data['no_cache']
+        )
 
-            filename = '{}_{}_{}.mp4'.format(
-                camera.name.replace(' ', '-'),
-                result.start_time.strftime('%Y%m%dT%H%M%S%z'),
-                result.end_time.strftime('%Y%m%dT%H%M%S%z')
-            )
+        filename = '{}_{}_{}.mp4'.format(
+            camera.slug,
+            compact_timestamp(result.start_time),
+            compact_timestamp(result.end_time)
+        )
 
-            job = self.ffmpeg.download(
-                camera,
-                result.rtsp_uri,
-                result.start_time,
-                result.end_time,
-                filename,
-                data['callback_uri']
-            )
+        job = self.ffmpeg.download(
+            camera,
+            result.rtsp_uri,
+            result.start_time,
+            result.end_time,
+            filename,
+            data['callback_uri']
+        )
 
-            return web.json_response(JobSchema().dump(job))
-        except CameraNotFoundException as ex:
-            raise web.HTTPNotFound(reason=str(ex))
-        except InvalidRangeException as ex:
-            raise web.HTTPConflict(reason=str(ex))
-        except RangeNotFoundException as ex:
-            raise web.HTTPRequestRangeNotSatisfiable(reason=str(ex))
+        return web.Response(body=self.ffmpeg.get_job_body_by_id(job['job_id']), content_type='application/json')
 
     @docs(
         summary='Get information about a job',
@@ -182,11 +307,27 @@ class Frankamera(object):
     )
     @response_schema(JobSchema())
     async def job(self, request: web.Request):
-        job = self.ffmpeg.get_job_by_id(request.match_info['job_id'])
-        if job is None:
+        body = self.ffmpeg.get_job_body_by_id(self._get_job_id(request))
+        if body is None:
             raise web.HTTPNotFound(reason='Job not found')
 
-        return web.json_response(JobSchema().dump(job))
+        return web.Response(body=body, content_type='application/json')
+
+    @docs(
+        summary='Get the video file of a finished job',
+        responses={
+            200: {'description': 'Video data'},
+            404: {'schema': ErrorResponseSchema, 'description': 'Job not found or not finished'},
+            500: {'schema': ErrorResponseSchema}
+        }
+    )
+    async def job_file(self, request: web.Request):
+        path = self.ffmpeg.get_file_by_id(self._get_job_id(request))
+        if path is None or not os.path.isfile(path):
+            raise web.HTTPNotFound(reason='Job file not found')
+
+        # Sent with sendfile(), the video data is never read into Python
+        return web.FileResponse(path, chunk_size=FILE_CHUNK_SIZE)
 
     @docs(
         summary='Get information about all the jobs',
@@ -196,7 +337,65 @@ class Frankamera(object):
     )
     @response_schema(JobSchema(many=True))
     async def active_jobs(self, request: web.Request):
-        return web.json_response(JobSchema(many=True).dump(self.ffmpeg.get_all_active_jobs()))
+        # Snapshots the cached job bodies and writes them one at a time, without joining them into one JSON document
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+
+        separator = b'['
+        for body in self.ffmpeg.get_all_active_job_bodies():
+            await response.write(separator + body)
+            separator = b','
+        await response.write(b'[]' if separator == b'[' else b']')
+
+        await response.write_eof()
+        return response
+
+    async def _search(
+            self,
+            camera_id: int,
+            start_time: datetime,
+            end_time: datetime,
+            no_cache: bool = False
+    ) -> Tuple[Camera, Result]:
+        key = (camera_id, start_time, end_time, no_cache)
+        search = self._searches.get(key)
+        if search is None:
+            # The DVR client is blocking, keep it off the event loop
+            search = asyncio.get_event_loop().run_in_executor(
+                self._dvr_executor,
+                self._search_dvr,
+                camera_id,
+                start_time,
+                end_time,
+                no_cache
+            )
+            self._searches[key] = search
+            search.add_done_callback(lambda _: self._searches.pop(key, None))
+
+        # Shielded, a client going away must not cancel the search for the others waiting on it
+        return await asyncio.shield(search)
+
+    def _search_dvr(
+            self,
+            camera_id: int,
+            start_time: datetime,
+            end_time: datetime,
+            no_cache: bool
+    ) -> Tuple[Camera, Result]:
+        camera = self.dvr.get_camera_by_id(camera_id)
+        return camera, self.dvr.search(camera, start_time, end_time, no_cache=no_cache)
+
+    @staticmethod
+    def _get_job_id(request: web.Request) -> str:
+        job_id = request.match_info['job_id']
+        # Job ids are always canonical UUIDs, anything else can't be a job and must not reach the file system
+        try:
+            if str(uuid.UUID(job_id)) == job_id:
+                return job_id
+        except ValueError:
+            pass
+
+        raise web.HTTPNotFound(reason='Job not found')
 
     @staticmethod
     def _frame_summary_to_tuple(frame: traceback.FrameSummary) -> Dict:
@@ -214,24 +413,20 @@ class Frankamera(object):
         error_status = 500
 
         try:
-            name = request.match_info.route.name
-            if self._api_key is not None and name is not None and name in self._protected_routes:
-                authorized_header = request.headers.getone('Authorization', None)
+            if self._api_key is not None and request.match_info.route.name in self._protected_routes:
+                authorized_header = request.headers.get('Authorization')
                 if not authorized_header:
                     raise web.HTTPUnauthorized(reason='No API key')
 
-                api_key = BearerAuth.decode(authorized_header)
-                if api_key != self._api_key:
-                    self._logger.warning('Invalid API key: {} != {}'.format(api_key, self._api_key))
+                if not self._api_key.matches(authorized_header):
+                    self._logger.warning('Invalid API key from {}'.format(request.remote))
                     raise web.HTTPUnauthorized(reason='Invalid API key')
 
             response = await handler(request)
         except Exception as ex:
-            self._logger.error(''.join(traceback.format_exception(type(ex), ex, ex.__traceback__, chain=True)))
-
             response = None
 
-            if isinstance(ex, json.JSONDecodeError):
+            if isinstance(ex, orjson.JSONDecodeError):
                 error = {'error': str(ex)}
                 error_status = 400
             elif isinstance(ex, exceptions.ValidationError):
@@ -240,16 +435,26 @@ class Frankamera(object):
             elif isinstance(ex, KeyError):
                 error = {'error': 'Key {} not found'.format(str(ex))}
                 error_status = 400
+            elif type(ex) in EXCEPTION_STATUS:
+                error = {'error': str(ex)}
+                error_status = EXCEPTION_STATUS[type(ex)]
             elif isinstance(ex, web.HTTPClientError) or isinstance(ex, web.HTTPError):
                 error = {'error': ex.reason}
                 error_status = ex.status
             elif isinstance(ex, web.HTTPException):
                 response = ex
+                error_status = ex.status
             else:
                 error = {'error': 'Unknown error: {}'.format(str(ex)), 'extra': {'class': str(ex.__class__)}}
                 error_status = 500
 
-            if self._config.get('debug', False):
+            if error_status < 500:
+                # Bad requests are part of normal operation, their tracebacks are only noise
+                self._logger.info('{} {} failed with {}: {}'.format(request.method, request.path, error_status, ex))
+            else:
+                self._logger.error('Error handling {} {}'.format(request.method, request.path), exc_info=ex)
+
+            if self._config['debug']:
                 error['extra'] = error.get('extra', {})
                 error['extra']['exception'] = str(ex.__class__)
                 error['extra']['message'] = str(ex)
@@ -258,26 +463,42 @@ class Frankamera(object):
                 ]
 
             if not response:
-                response = web.json_response(ErrorResponseSchema().dump(error), status=error_status)
-
-        response.headers['server'] = 'Frankamera'
+                # The error dicts are built to match ErrorResponseSchema, no need to dump them through it
+                response = json_response(error, status=error_status)
 
         return response
 
     def add_route(self, method: str, route: str, handler, name: Optional[str] = None, **kwargs):
         if name is not None:
-            self._protected_routes[name] = True
+            self._protected_routes.add(name)
         return web.route(method, route, handler, name=name, **kwargs)
 
+    @staticmethod
+    async def _add_server_header(request: web.Request, response: web.StreamResponse):
+        response.headers['Server'] = SERVER_NAME
+
+    async def _startup(self, app: web.Application):
+        self._dvr_executor = ThreadPoolExecutor(max_workers=DVR_WORKERS, thread_name_prefix='dvr')
+
+    async def _cleanup(self, app: web.Application):
+        await self.ffmpeg.close()
+        self._dvr_executor.shutdown(wait=False)
+
     def run(self):
         app = web.Application(middlewares=[self.process_request])
+        app.on_response_prepare.append(self._add_server_header)
+        app.on_startup.append(self._startup)
+        app.on_cleanup.append(self._cleanup)
         app.add_routes([
             self.add_route('GET', '/cameras', self.cameras, name='cameras', allow_head=False),
             self.add_route('POST', '/search', self.search, name='search'),
             self.add_route('POST', '/download', self.download, name='download'),
             self.add_route('GET', '/job/{job_id}', self.job, name='job', allow_head=False),
+            self.add_route('GET', '/job/{job_id}/file', self.job_file, name='job_file', allow_head=False),
             self.add_route('GET', '/active_jobs', self.active_jobs, name='active_jobs', allow_head=False),
         ])
+        # All the routes are known now
+        self._protected_routes = frozenset(self._protected_routes)
 
         setup_aiohttp_apispec(
             app,
@@ -295,7 +516,15 @@ class Frankamera(object):
             security=[{'api_key': []}]
         )
 
-        web.run_app(app, port=self._port)
+        if uvloop is not None:
+            uvloop.install()
+
+        try:
+            web.run_app(app, port=self._port)
+        finally:
+            # Flushes the records still queued
+            for listener in self._log_listeners:
+                listener.stop()
 
 
 if __name__ == '__main__':
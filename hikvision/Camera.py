@@ -1,4 +1,5 @@
 from marshmallow import Schema, fields
+from typing import Dict, List
 
 
 class CameraSchema(Schema):
@@ -9,12 +10,16 @@ class CameraSchema(Schema):
 
 
 class Camera(object):
+    __slots__ = ('_id', '_name', '_slug', '_ip_address', '_status', '_channels', '_dict')
+
     def __init__(self, camera_id: int, name: str, ip_address: str):
         self._id = camera_id
         self._name = name
+        self._slug = name.replace(' ', '-')
         self._ip_address = ip_address
         self._status = False
         self._channels = []
+        self._dict = {'id': camera_id, 'name': name, 'ip_address': ip_address, 'status': False}
 
     @property
     def id(self) -> int:
@@ -24,6 +29,10 @@ class Camera(object):
     def name(self) -> str:
         return self._name
 
+    @property
+    def slug(self) -> str:
+        return self._slug
+
     @property
     def ip_address(self) -> str:
         return self._ip_address
@@ -35,13 +44,22 @@ class Camera(object):
     @status.setter
     def status(self, status: bool):
         self._status = status
+        self._dict['status'] = status
 
     @property
-    def channels(self):
+    def channels(self) -> List[int]:
         return self._channels
 
-    def add_channel(self, channel: int):
-        self._channels.append(channel)
+    @channels.setter
+    def channels(self, channels: List[int]):
+        self._channels = channels
+
+    def to_dict(self) -> Dict:
+        """
+        The same dict as CameraSchema().dump(camera), without going through marshmallow. It is kept up to date by the
+        camera, so don't modify it
+        """
+        return self._dict
 
     def __str__(self):
         return self.name
@@ -1,11 +1,15 @@
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from hikvisionapi import Client
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException as BaseRequestException
-from typing import Dict, Optional
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 from tzlocal import get_localzone
-from urllib.parse import urlparse, urlunparse, urlencode, ParseResult
-import uuid
-import xmltodict
+from xml.etree import ElementTree
 
 from .Camera import Camera
 from .Exceptions import (
@@ -18,6 +22,26 @@ from .Exceptions import (
 from .Result import Result
 
 CAMERA_REFRESH_INTERVAL = timedelta(minutes=15)
+# Repeated searches for the same range within this many seconds are answered from memory
+SEARCH_CACHE_TTL = 15
+SEARCH_CACHE_SIZE = 256
+# Kept-alive connections to the DVR, enough for every thread that may call it at the same time
+CONNECTION_POOL_SIZE = 16
+# Booleans in ISAPI responses, anything else is taken as false
+BOOLEAN_VALUES = {'true': True, 'TRUE': True, 'false': False, 'FALSE': False}
+
+# The search request only differs in these values, so it is not built as a document every time
+SEARCH_XML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<CMSearchDescription>'
+    '<searchID>{search_id[0]}-{search_id[1]}-{search_id[2]}-{search_id[3]}-{search_id[4]}</searchID>'
+    '<trackList><trackID>{track_id}</trackID></trackList>'
+    '<timeSpanList><timeSpan><startTime>{start_time}</startTime><endTime>{end_time}</endTime></timeSpan></timeSpanList>'
+    '<maxResults>50</maxResults>'
+    '<searchResultPosition>0</searchResultPosition>'
+    '<metadataList><metadataDescriptor>//recordType.meta.std-cgi.com</metadataDescriptor></metadataList>'
+    '</CMSearchDescription>'
+)
 
 
 class Hikvision(object):
@@ -30,13 +54,34 @@ class Hikvision(object):
         self._base_url = base_url
         self._username = username
         self._password = password
+        self._tz = get_localzone()
         self._client = None
+        # The endpoints are built attribute by attribute by hikvisionapi, they are bound once with the client
+        self._channels_endpoint = None
+        self._channel_statuses_endpoint = None
+        self._search_endpoint = None
+        # Runs the independent requests of a camera refresh at the same time
+        self._executor = ThreadPoolExecutor(max_workers=2)
         self._cameras = {}
-        self._last_camera_refresh = datetime.utcfromtimestamp(0)
+        self._last_camera_refresh = datetime.fromtimestamp(0, tz=timezone.utc)
+        # When the cameras are due for a refresh, on the monotonic clock
+        self._next_camera_refresh = 0.0
+        self._camera_refresh_lock = threading.Lock()
+        # (camera id, start timestamp, end timestamp) -> (expiry on the monotonic clock, result), oldest first
+        self._search_cache = OrderedDict()
+        self._search_cache_lock = threading.Lock()
 
     def _get_client(self) -> Client:
         if self._client is None:
-            self._client = Client(self._base_url, self._username, self._password)
+            client = Client(self._base_url, self._username, self._password)
+            # All requests go to the same host, keep one pool that holds a connection for every concurrent caller
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CONNECTION_POOL_SIZE)
+            client.req.mount('http://', adapter)
+            client.req.mount('https://', adapter)
+            self._channels_endpoint = client.ContentMgmt.InputProxy.channels
+            self._channel_statuses_endpoint = client.ContentMgmt.InputProxy.channels.status
+            self._search_endpoint = client.ContentMgmt.search
+            self._client = client
         return self._client
 
     @property
@@ -44,109 +89,159 @@ class Hikvision(object):
         self.refresh_cameras()
         return self._cameras
 
+    @property
+    def last_camera_refresh(self) -> datetime:
+        return self._last_camera_refresh
+
     def get_camera_by_id(self, camera_id: int) -> Camera:
-        if camera_id not in self.cameras:
+        camera = self.cameras.get(camera_id)
+        if camera is None:
             raise CameraNotFoundException(camera_id)
-        return self.cameras[camera_id]
+        return camera
 
     def refresh_cameras(self):
-        if self._last_camera_refresh + CAMERA_REFRESH_INTERVAL > datetime.utcnow():
+        if time.monotonic() < self._next_camera_refresh:
             return
 
+        # Only one thread refreshes, the others wait for it and then use its result
+        with self._camera_refresh_lock:
+            if time.monotonic() < self._next_camera_refresh:
+                return
+
+            # Connect before fetching, so both requests use the same client and its endpoints
+            self._get_client()
+            channels = self._executor.submit(self._get_channels)
+            statuses = self._executor.submit(self._get_channel_statuses)
+            channels = channels.result()
+            statuses = statuses.result()
+
+            for camera in channels:
+                status = statuses.get(camera.id)
+                if status is not None:
+                    camera.status, camera.channels = status
+
+            # Swapped in as a whole, readers on other threads keep iterating the dict they already have
+            self._cameras = {camera.id: camera for camera in channels}
+
+            self._last_camera_refresh = datetime.now(tz=timezone.utc)
+            self._next_camera_refresh = time.monotonic() + CAMERA_REFRESH_INTERVAL.total_seconds()
+
+            # The channels may have changed, don't answer from results of before the refresh
+            with self._search_cache_lock:
+                self._search_cache.clear()
+
+    def _get_channels(self) -> List[Camera]:
         try:
-            response = self._get_client().ContentMgmt.InputProxy.channels(method='get')
-            if 'InputProxyChannelList' not in response or 'InputProxyChannel' not in response['InputProxyChannelList']:
-                raise ResponseException('Invalid response while fetching cameras', response)
+            response = self._channels_endpoint(method='get', present='text')
         except BaseRequestException as ex:
             raise RequestException('Could not connect to Hikvision DVR: {}'.format(ex))
 
-        for camera in response['InputProxyChannelList']['InputProxyChannel']:
-            camera_id = int(camera['id'])
-            self._cameras[camera_id] = Camera(
-                camera_id,
-                camera['name'],
-                camera['sourceInputPortDescriptor']['ipAddress']
+        message = 'Invalid response while fetching cameras'
+        root, ns = Hikvision._parse_response(response, 'InputProxyChannelList', message)
+        items = root.findall(ns + 'InputProxyChannel')
+        if not items:
+            raise ResponseException(message, response)
+
+        return [
+            Camera(
+                int(item.findtext(ns + 'id')),
+                item.findtext(ns + 'name'),
+                item.findtext('{0}sourceInputPortDescriptor/{0}ipAddress'.format(ns))
             )
+            for item in items
+        ]
 
+    def _get_channel_statuses(self) -> Dict[int, Tuple[bool, List[int]]]:
         try:
-            response = self._get_client().ContentMgmt.InputProxy.channels.status(method='get')
-            if 'InputProxyChannelStatusList' not in response \
-                    or 'InputProxyChannelStatus' not in response['InputProxyChannelStatusList']:
-                raise ResponseException('Invalid response while fetching camera statuses', response)
+            response = self._channel_statuses_endpoint(method='get', present='text')
         except BaseRequestException as ex:
             raise RequestException('Could not connect to Hikvision DVR: {}'.format(ex))
 
-        for status in response['InputProxyChannelStatusList']['InputProxyChannelStatus']:
-            camera_id = int(status['id'])
-            self._cameras[camera_id].status = status['online'] == 'true'
-            if 'streamingProxyChannelIdList' in status and status['streamingProxyChannelIdList'] is not None:
-                for channel in status['streamingProxyChannelIdList']['streamingProxyChannelId']:
-                    self._cameras[camera_id].add_channel(int(channel))
+        message = 'Invalid response while fetching camera statuses'
+        root, ns = Hikvision._parse_response(response, 'InputProxyChannelStatusList', message)
+        items = root.findall(ns + 'InputProxyChannelStatus')
+        if not items:
+            raise ResponseException(message, response)
+
+        channel_path = '{0}streamingProxyChannelIdList/{0}streamingProxyChannelId'.format(ns)
+        return {
+            int(item.findtext(ns + 'id')): (
+                BOOLEAN_VALUES.get(item.findtext(ns + 'online'), False),
+                [int(channel.text) for channel in item.iterfind(channel_path)]
+            )
+            for item in items
+        }
+
+    def search(self, camera: Camera, start_time: datetime, end_time: datetime, no_cache: bool = False) -> Result:
+        key = (camera.id, start_time.timestamp(), end_time.timestamp())
+        now = time.monotonic()
+
+        if not no_cache:
+            with self._search_cache_lock:
+                cached = self._search_cache.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        result = self._search(camera, start_time, end_time)
+
+        with self._search_cache_lock:
+            self._search_cache[key] = (now + SEARCH_CACHE_TTL, result)
+            self._search_cache.move_to_end(key)
+            while len(self._search_cache) > SEARCH_CACHE_SIZE:
+                self._search_cache.popitem(last=False)
 
-        self._last_camera_refresh = datetime.utcnow()
+        return result
 
-    def search(self, camera: Camera, start_time: datetime, end_time: datetime) -> Result:
-        tz = get_localzone()
+    def _search(self, camera: Camera, start_time: datetime, end_time: datetime) -> Result:
+        tz = self._tz
 
-        # If no timezone is set, assume the datetime is in the local timezone
+        # If no timezone is set, assume the datetime is in the local timezone, otherwise convert it. Only localized
+        # datetimes need normalizing, in case they fall in a DST gap, astimezone() already gets the offset right
         if start_time.utcoffset() is None:
-            start_time = tz.localize(start_time)
+            start_time = tz.normalize(tz.localize(start_time))
+        else:
+            start_time = start_time.astimezone(tz)
         if end_time.utcoffset() is None:
-            end_time = tz.localize(end_time)
-
-        # Make sure we work with datetimes that are in the local timezone
-        start_time = tz.normalize(start_time.astimezone(tz))
-        end_time = tz.normalize(end_time.astimezone(tz))
+            end_time = tz.normalize(tz.localize(end_time))
+        else:
+            end_time = end_time.astimezone(tz)
 
         if end_time <= start_time:
             raise InvalidRangeException(start_time, end_time)
 
-        data = xmltodict.unparse({
-            'CMSearchDescription': {
-                'searchID': uuid.uuid4(),
-                'trackList': [{
-                    'trackID': camera.channels[0]
-                }],
-                'timeSpanList': [{
-                    'timeSpan': {
-                        'startTime': start_time.isoformat(),
-                        'endTime': end_time.isoformat()
-                    }
-                }],
-                'maxResults': 50,
-                'searchResultPosition': 0,
-                'metadataList': [{
-                    'metadataDescriptor': '//recordType.meta.std-cgi.com',
-                }]
-            }
-        })
+        # The DVR only needs a unique id in the form of a UUID, random hex is enough
+        search_id = os.urandom(16).hex()
+        data = SEARCH_XML.format(
+            search_id=(search_id[:8], search_id[8:12], search_id[12:16], search_id[16:20], search_id[20:]),
+            track_id=camera.channels[0],
+            start_time=start_time.isoformat(),
+            end_time=end_time.isoformat()
+        )
 
         headers = {'content-type': 'application/xml; charset="UTF-8"'}
+        self._get_client()
         try:
-            response = self._get_client().ContentMgmt.search(method='post', data=data, headers=headers)
-            if 'CMSearchResult' not in response \
-                    or 'responseStatus' not in response['CMSearchResult'] \
-                    or response['CMSearchResult']['responseStatus'] != 'true' \
-                    or 'numOfMatches' not in response['CMSearchResult']:
-                raise ResponseException('Invalid response while searching', response)
+            response = self._search_endpoint(method='post', data=data, headers=headers, present='text')
         except BaseRequestException as ex:
             raise RequestException('Could not connect to Hikvision DVR: {}'.format(ex))
 
+        root, ns = Hikvision._parse_response(response, 'CMSearchResult', 'Invalid response while searching')
+        num_of_matches = root.findtext(ns + 'numOfMatches')
+        if root.findtext(ns + 'responseStatus') != 'true' or num_of_matches is None:
+            raise ResponseException('Invalid response while searching', response)
+
         result = None
-        if int(response['CMSearchResult']['numOfMatches']) > 0:
-            items = response['CMSearchResult']['matchList']['searchMatchItem']
-            if isinstance(items, dict):
-                items = [items]
+        items = root.findall('{0}matchList/{0}searchMatchItem'.format(ns)) if int(num_of_matches) > 0 else []
+        if items:
+            first_start_time = items[0].findtext('{0}timeSpan/{0}startTime'.format(ns))
+            last_end_time = items[-1].findtext('{0}timeSpan/{0}endTime'.format(ns))
 
-            # These timestamps are not actually UTC, but the local time on the DVR
+            # These timestamps are not actually UTC, but the local time on the DVR. Without the Z they are plain
+            # ISO 8601 local times, which fromisoformat() parses without going through a format string like strptime()
             result = {
-                'start_time': tz.normalize(
-                    tz.localize(datetime.strptime(items[0]['timeSpan']['startTime'], '%Y-%m-%dT%H:%M:%SZ'))
-                ),
-                'end_time': tz.normalize(
-                    tz.localize(datetime.strptime(items[-1]['timeSpan']['endTime'], '%Y-%m-%dT%H:%M:%SZ'))
-                ),
-                'rtsp_uri': items[0]['mediaSegmentDescriptor']['playbackURI']
+                'start_time': tz.normalize(tz.localize(datetime.fromisoformat(first_start_time.rstrip('Z')))),
+                'end_time': tz.normalize(tz.localize(datetime.fromisoformat(last_end_time.rstrip('Z')))),
+                'rtsp_uri': items[0].findtext('{0}mediaSegmentDescriptor/{0}playbackURI'.format(ns))
             }
 
         if result is None:
@@ -158,16 +253,24 @@ class Hikvision(object):
         if result['end_time'] < end_time:
             end_time = result['end_time']
 
-        parsed_uri = urlparse(result['rtsp_uri'])
-        rtsp_uri = urlunparse(
-            ParseResult(
-                parsed_uri.scheme,
-                parsed_uri.netloc,
-                parsed_uri.path,
-                '',
-                urlencode({'starttime': start_time.strftime('%Y%m%dT%H%M%SZ')}),
-                ''
-            )
+        # Only the query of the playback URI changes, the rest is kept as the DVR returned it
+        rtsp_uri = '{}?starttime={}'.format(
+            result['rtsp_uri'].partition('?')[0],
+            start_time.strftime('%Y%m%dT%H%M%SZ')
         )
 
         return Result(camera.id, start_time, end_time, rtsp_uri)
+
+    @staticmethod
+    def _parse_response(response: str, root_tag: str, message: str) -> Tuple[ElementTree.Element, str]:
+        try:
+            root = ElementTree.fromstring(response)
+        except ElementTree.ParseError:
+            raise ResponseException(message, response)
+
+        # All the elements are in the namespace of the root element
+        ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+        if root.tag != ns + root_tag:
+            raise ResponseException(message, response)
+
+        return root, ns
@@ -1,5 +1,6 @@
 from datetime import datetime
 from marshmallow import Schema, fields
+from typing import Dict
 
 
 class ResultSchema(Schema):
@@ -10,11 +11,14 @@ class ResultSchema(Schema):
 
 
 class Result(object):
+    __slots__ = ('_camera_id', '_start_time', '_end_time', '_rtsp_uri', '_dict')
+
     def __init__(self, camera_id: int, start_time: datetime, end_time: datetime, rtsp_uri: str):
         self._camera_id = camera_id
         self._start_time = start_time
         self._end_time = end_time
         self._rtsp_uri = rtsp_uri
+        self._dict = {'camera_id': camera_id, 'start_time': start_time, 'end_time': end_time, 'rtsp_uri': rtsp_uri}
 
     @property
     def camera_id(self) -> int:
@@ -31,3 +35,10 @@ class Result(object):
     @property
     def rtsp_uri(self) -> str:
         return self._rtsp_uri
+
+    def to_dict(self) -> Dict:
+        """
+        The same dict as ResultSchema().dump(result) when serialized with orjson, without going through marshmallow.
+        Don't modify it
+        """
+        return self._dict